@@ -1,5 +1,6 @@
 import torch.nn as nn
 import torch
+from safetensors.torch import load_file
 
 from models.reveal.model import MetricLearningModel
 
@@ -8,7 +9,7 @@ class InterpretModel(nn.Module):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.model = MetricLearningModel(input_dim=200, hidden_dim=256)
-        self.model.load_state_dict(torch.load('../vul4c_dataset_best_f1.model'))
+        self.model.load_state_dict(load_file('../vul4c_dataset_best_f1.safetensors'))
         self.model.eval()
         self.model.to('cuda')
 
@@ -40,6 +40,8 @@ class DataSet:
         self.hdim = hdim
         self.positive_indices_in_train = []
         self.negative_indices_in_train = []
+        # page-locked batches allow non_blocking host -> device copies in the trainer
+        self.pin_memory = torch.cuda.is_available()
 
     def initialize_dataset(self, balance=True, output_buffer=sys.stderr):
         if isinstance(balance, bool) and balance:
@@ -177,7 +179,10 @@ class DataSet:
             ids[tidx] = entry._id
             for feature_idx in range(self.hdim):
                 features[tidx, feature_idx] = entry.features[feature_idx]
-        return torch.FloatTensor(features), torch.LongTensor(targets), torch.LongTensor(ids),
+        features, targets, ids = torch.FloatTensor(features), torch.LongTensor(targets), torch.LongTensor(ids)
+        if self.pin_memory:
+            features, targets, ids = features.pin_memory(), targets.pin_memory(), ids.pin_memory()
+        return features, targets, ids,
         pass
 
     def find_same_class_data(self, ignore_indices):
@@ -232,11 +237,13 @@ def create_dataset(ggnn_output, batch_size=32, output_buffer=sys.stderr):
         print('Reading Test data from', file=output_buffer)
     test_data, test_labels , test_ids = ggnn_output[2]
     print('!!!!!!!!!!!!!!!!!!!! test id !!!!!!!!!!!!!!!!!! ')
-    print(test_ids.int().tolist())
-    print(len(test_ids.int().tolist()))
+    # convert the ids in one transfer instead of one .cpu() per entry
+    test_ids = test_ids.int().cpu().tolist()
+    print(test_ids)
+    print(len(test_ids))
 
     for i in range(len(test_data)):
-        dataset.add_data_entry(test_data[i].cpu().numpy(), test_labels[i].cpu().numpy(),_id=test_ids[i].int().cpu().numpy() ,  part='test')
+        dataset.add_data_entry(test_data[i].cpu().numpy(), test_labels[i].cpu().numpy(),_id=test_ids[i] ,  part='test')
 
     # dataset.initialize_dataset()
     return dataset
@@ -52,7 +52,13 @@ class MetricLearningModel(nn.Module):
         train_mode = (positive_batch is not None and
                       negative_batch is not None and
                       targets is not None)
-        h_a = self.extract_feature(example_batch)
+        if train_mode:
+            # anchor / positive / negative share the encoder, so run it once on the packed batch
+            h_a, h_p, h_n = self.extract_feature(
+                torch.cat([example_batch, positive_batch, negative_batch], dim=0)
+            ).split([example_batch.size(0), positive_batch.size(0), negative_batch.size(0)])
+        else:
+            h_a = self.extract_feature(example_batch)
         y_a = self.classifier(h_a)
         probs = torch.exp(y_a)
         batch_loss = None
@@ -60,8 +66,6 @@ class MetricLearningModel(nn.Module):
             ce_loss = self.loss_function(input=y_a, target=targets)
             batch_loss = ce_loss.sum(dim=-1)
         if train_mode:
-            h_p = self.extract_feature(positive_batch)
-            h_n = self.extract_feature(negative_batch)
             dot_p = h_a.unsqueeze(dim=1) \
                 .bmm(h_p.unsqueeze(dim=-1)).squeeze(-1).squeeze(-1)
             dot_n = h_a.unsqueeze(dim=1) \
@@ -72,7 +76,6 @@ class MetricLearningModel(nn.Module):
             D_plus = 1 - (dot_p / (mag_a * mag_p))
             D_minus = 1 - (dot_n / (mag_a * mag_n))
             trip_loss = self.lambda1 * torch.abs((D_plus - D_minus + self.alpha))
-            ce_loss = self.loss_function(input=y_a, target=targets)
             l2_loss = self.lambda2 * (mag_a + mag_p + mag_n)
             total_loss = ce_loss + trip_loss + l2_loss
             batch_loss = (total_loss).sum(dim=-1)
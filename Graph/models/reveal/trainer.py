@@ -1,8 +1,11 @@
-import copy
-import json
+import importlib.util
 import pickle
+import queue
 import sys
+import threading
+from operator import itemgetter
 import numpy as np
+import orjson
 import sys
 from pathlib import Path
 
@@ -12,8 +15,11 @@ sys.path.append(str((Path(__file__).parent)))
 sys.path.append(str((Path(__file__).parent.parent.parent)))
 import torch
 from graph_dataset import DataSet
+from safetensors.torch import save_file, load_file
 from sklearn.metrics import accuracy_score as acc, precision_score as pr, recall_score as rc, f1_score as f1, \
-    average_precision_score,roc_auc_score
+    roc_auc_score
+from torchmetrics.functional.classification import binary_accuracy, binary_precision, binary_recall, \
+    binary_f1_score, binary_average_precision
 from tqdm import tqdm
 from tsne import plot_embedding
 
@@ -21,8 +27,73 @@ from models.reveal.model import MetricLearningModel
 from utils.utils import RunTimeCounter, ModelParameterCounter
 
 
+def compile_model(model, cuda_device):
+    # parameters are shared with `model`, so state_dict save/load keeps using the original module.
+    # Built once per module and reused by train() and every eval entry point: re-wrapping with another mode
+    # needs a dynamo reset on torch 2.0/2.1, and every extra wrapper eats into dynamo's cache_size_limit
+    if cuda_device == -1 or not hasattr(torch, 'compile'):
+        return model
+    compiled = model.__dict__.get('_compiled_wrapper')
+    if compiled is None:
+        if importlib.util.find_spec('triton') is None:
+            compiled = torch.compile(model, backend='eager')
+        else:
+            compiled = torch.compile(model, mode='reduce-overhead', dynamic=False)
+        # stored in __dict__ directly so nn.Module does not register it as a submodule (and in state_dict)
+        model.__dict__['_compiled_wrapper'] = compiled
+    return compiled
+
+
+def prefetch_batches(batch_fn, num_batches, prefetch_factor=2):
+    # assemble batches on a background thread so CPU-side batching overlaps GPU compute;
+    # a single producer keeps the batch order and numpy sampling identical to the serial loop
+    batch_queue = queue.Queue(maxsize=prefetch_factor)
+
+    def producer():
+        try:
+            for _ in range(num_batches):
+                batch_queue.put(batch_fn())
+        except Exception as e:
+            batch_queue.put(e)
+
+    threading.Thread(target=producer, daemon=True).start()
+    for _ in range(num_batches):
+        batch = batch_queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        yield batch
+
+
+def create_copy_stream(cuda_device):
+    if cuda_device == -1:
+        return None
+    return torch.cuda.Stream(device=cuda_device)
+
+
+def to_device(tensors, cuda_device, copy_stream=None):
+    # async H2D copy of (pinned) batch tensors on a side stream, overlapping with in-flight compute
+    if cuda_device == -1:
+        return tensors
+    if copy_stream is None:
+        return [t.to(f'cuda:{cuda_device}', non_blocking=True) for t in tensors]
+    with torch.cuda.stream(copy_stream):
+        moved = [t.to(f'cuda:{cuda_device}', non_blocking=True) for t in tensors]
+    current_stream = torch.cuda.current_stream(cuda_device)
+    current_stream.wait_stream(copy_stream)
+    for t in moved:
+        t.record_stream(current_stream)
+    return moved
+
+
+def autocast(cuda_device, dtype=torch.bfloat16):
+    return torch.autocast('cuda', dtype=dtype, enabled=cuda_device != -1)
+
+
 def train(model : MetricLearningModel, dataset : DataSet, optimizer, num_epochs, dataset_name, max_patience=5,
           valid_every=1, cuda_device=-1, output_buffer=sys.stderr):
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision('high')
+    torch.backends.cuda.matmul.allow_tf32 = True
     time_counter = RunTimeCounter()
     ModelParameterCounter().summary(model,'Reveal')
     if output_buffer is not None:
@@ -31,31 +102,32 @@ def train(model : MetricLearningModel, dataset : DataSet, optimizer, num_epochs,
     best_model = None
     patience_counter = 0
     train_losses = []
+    compiled = compile_model(model, cuda_device)
+    copy_stream = create_copy_stream(cuda_device)
+    scaler = torch.cuda.amp.GradScaler(enabled=cuda_device != -1)
     try:
         for epoch_count in range(num_epochs):
-            batch_losses = []
+            # kept on the loss device, so .item() syncs once per epoch instead of once per step
+            loss_sum = 0.0
             num_batches = dataset.initialize_train_batches()
-            output_batches_generator = range(num_batches)
+            output_batches_generator = prefetch_batches(dataset.get_next_train_batch, num_batches)
             if output_buffer is not None:
-                output_batches_generator = tqdm(output_batches_generator)
-            for _ in output_batches_generator:
+                output_batches_generator = tqdm(output_batches_generator, total=num_batches)
+            for features, targets, same_class_features, diff_class_features in output_batches_generator:
                 model.train()
-                model.zero_grad()
-                optimizer.zero_grad()
-                features, targets, same_class_features, diff_class_features = dataset.get_next_train_batch()
-                if cuda_device != -1:
-                    features = features.cuda(device=cuda_device)
-                    targets = targets.cuda(device=cuda_device)
-                    same_class_features = same_class_features.cuda(device=cuda_device)
-                    diff_class_features = diff_class_features.cuda(device=cuda_device)
-                probabilities, representation, batch_loss = model(
-                    example_batch=features, targets=targets,
-                    positive_batch=same_class_features, negative_batch=diff_class_features
-                )
-                batch_losses.append(batch_loss.detach().cpu().item())
-                batch_loss.backward()
-                optimizer.step()
-            epoch_loss = np.sum(batch_losses).item()
+                optimizer.zero_grad(set_to_none=True)
+                features, targets, same_class_features, diff_class_features = to_device(
+                    (features, targets, same_class_features, diff_class_features), cuda_device, copy_stream)
+                with autocast(cuda_device, dtype=torch.float16):
+                    probabilities, representation, batch_loss = compiled(
+                        example_batch=features, targets=targets,
+                        positive_batch=same_class_features, negative_batch=diff_class_features
+                    )
+                loss_sum = loss_sum + batch_loss.detach()
+                scaler.scale(batch_loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+            epoch_loss = float(loss_sum)
             train_losses.append(epoch_loss)
             if output_buffer is not None:
                 print('=' * 100, file=output_buffer)
@@ -68,14 +140,14 @@ def train(model : MetricLearningModel, dataset : DataSet, optimizer, num_epochs,
                 if vf1 > best_f1:
                     best_f1 = vf1
                     patience_counter = 0
-                    best_model = copy.deepcopy(model.state_dict())
-                    with open(f"./{dataset_name}_best_f1.model", "wb") as f:
-                        torch.save(best_model, f)
+                    # device-side snapshot; serialized once after training instead of on every improvement
+                    best_model = {k: v.detach().clone() for k, v in model.state_dict().items()}
                 else:
                     patience_counter += 1
-                # if dataset.initialize_test_batches() != 0:
+                # test_batch_count = dataset.initialize_test_batches()
+                # if test_batch_count != 0:
                 #     tacc, tpr, trc, tf1, tprauc , _ , _ , _ , _ = evaluate(
-                #         model, dataset.get_next_test_batch, dataset.initialize_test_batches(), cuda_device,
+                #         model, dataset.get_next_test_batch, test_batch_count, cuda_device,
                 #         output_buffer=output_buffer
                 #     )
                 #     if output_buffer is not None:
@@ -103,23 +175,24 @@ def train(model : MetricLearningModel, dataset : DataSet, optimizer, num_epochs,
     time_counter.stop('Reveal train done!')
 
     # Test begin
+    if best_model is not None:
+        save_file(best_model, f"./{dataset_name}_best_f1.safetensors")
     print('load best f1 model')
-    model.load_state_dict(torch.load(f'./{dataset_name}_best_f1.model'))
+    model.load_state_dict(load_file(f"./{dataset_name}_best_f1.safetensors"))
 
-    if dataset.initialize_test_batches() != 0:
+    test_batch_count = dataset.initialize_test_batches()
+    if test_batch_count != 0:
         tacc, tpr, trc, tf1, tprauc ,  expectations, all_probs , all_ids , predications = evaluate(
-            model, dataset.get_next_test_batch, dataset.initialize_test_batches(), cuda_device)
+            model, dataset.get_next_test_batch, test_batch_count, cuda_device)
 
         print(all_probs)
         print(expectations)
         print(len(all_probs))
 
-        with open(result_dir() / f"reveal/{dataset_name}" / f"test.json", mode='w') as f:
-            ans = []
-            for id, p in zip(all_ids, predications):
-                ans.append({'id': id, 'pred': p})
-            ans.sort(key=lambda item:item['id'])
-            json.dump(ans, f, indent=4)
+        with open(result_dir() / f"reveal/{dataset_name}" / f"test.json", mode='wb') as f:
+            pairs = sorted(zip(all_ids, predications), key=itemgetter(0))
+            ans = [{'id': id, 'pred': p} for id, p in pairs]
+            f.write(orjson.dumps(ans, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
 
         # print(acc(expectations,pred))
 
@@ -128,7 +201,7 @@ def train(model : MetricLearningModel, dataset : DataSet, optimizer, num_epochs,
         print('*' * 100, file=output_buffer)
         print('Test Set: Acc: %6.4f\tF1: %6.4f\tRc %6.4f\tPr: %6.4f\tPRAUC %6.4f' % \
               (tacc, tf1, trc, tpr, tprauc), file=output_buffer)
-        print('roc_auc ',roc_auc_score(expectations,all_probs))
+        print('roc_auc ',roc_auc_score(np.asarray(expectations, dtype=np.int8), np.asarray(all_probs, dtype=np.float32)))
         print('%f\t%f\t%f\t%f' % (tacc, tpr, trc, tf1))
         print('*' * 100, file=output_buffer)
         print('*' * 100, file=output_buffer)
@@ -146,107 +219,135 @@ def predict(model, iterator_function, _batch_count, cuda_device):
 
 def predict_proba(model, iterator_function, _batch_count, cuda_device):
     model.eval()
-    with torch.no_grad():
-        predictions = []
-        for _ in tqdm(range(_batch_count)):
-            features, targets, _ = iterator_function()
-            if cuda_device != -1:
-                features = features.cuda(device=cuda_device)
-            probs, _, _ = model(example_batch=features)
-            predictions.extend(probs.detach().cpu().numpy())
+    compiled = compile_model(model, cuda_device)
+    copy_stream = create_copy_stream(cuda_device)
+    with torch.inference_mode():
+        # filled in place on the device and sized as _batch_count * (first batch size). That covers every entry
+        # if the first batch is a full one; DataSet.create_batches puts the smaller remainder batch last and
+        # get_next_*_batch pops from the end, so the remainder arrives first and the buffer is regrown once
+        predictions = None
+        num_predictions = 0
+        for features, targets, _ in tqdm(prefetch_batches(iterator_function, _batch_count), total=_batch_count):
+            features, = to_device((features,), cuda_device, copy_stream)
+            with autocast(cuda_device):
+                probs, _, _ = compiled(example_batch=features)
+            batch_size = probs.size(0)
+            if predictions is None or num_predictions + batch_size > predictions.size(0):
+                grown = probs.new_empty((max(num_predictions + batch_size, _batch_count * batch_size), probs.size(1)))
+                if predictions is not None:
+                    grown[:num_predictions] = predictions[:num_predictions]
+                predictions = grown
+            predictions[num_predictions:num_predictions + batch_size] = probs
+            num_predictions += batch_size
         model.train()
-    return np.array(predictions)
+    if predictions is None:
+        return np.empty((0, 2), dtype=np.float32)
+    return predictions[:num_predictions].cpu().numpy()
 
 
 def evaluate(model, iterator_function, _batch_count, cuda_device, output_buffer=sys.stderr):
     # if output_buffer is not None:
     #     print(_batch_count, file=output_buffer)
     model.eval()
-    with torch.no_grad():
-        predictions = []
-        expectations = []
-        all_probs = []
-        all_ids = []
-        batch_generator = range(_batch_count)
+    compiled = compile_model(model, cuda_device)
+    copy_stream = create_copy_stream(cuda_device)
+    with torch.inference_mode():
+        probs_list = []
+        tgt_list = []
+        ids_list = []
+        batch_generator = prefetch_batches(iterator_function, _batch_count)
         if output_buffer is not None:
-            batch_generator = tqdm(batch_generator)
-        for _ in batch_generator:
-            features, targets, test_ids = iterator_function()
-            if cuda_device != -1:
-                features = features.cuda(device=cuda_device)
+            batch_generator = tqdm(batch_generator, total=_batch_count)
+        for features, targets, test_ids in batch_generator:
+            features, = to_device((features,), cuda_device, copy_stream)
 
-            probs, _, _ = model(example_batch=features)
+            with autocast(cuda_device):
+                probs, _, _ = compiled(example_batch=features)
 
-            probs = probs.detach().cpu().numpy()
-            batch_pred = np.argmax(probs, axis=-1).tolist()
-            batch_tgt = targets.detach().cpu().numpy().tolist()
-            predictions.extend(batch_pred)
-            expectations.extend(batch_tgt)
-            all_ids.extend(test_ids.cpu().tolist())
-            all_probs.extend(probs[:, 1])
+            # cloned: the next CUDA graph replay overwrites the compiled model's output buffers
+            probs_list.append(probs.clone())
+            tgt_list.append(targets)
+            ids_list.append(test_ids)
         model.train()
+        probs = torch.cat(probs_list)
+        targets = torch.cat(tgt_list)
+        preds = probs.argmax(-1)
+        device_targets = targets.to(probs.device)
+        accuracy, precision, recall, f1_score, pr_auc = torch.stack([
+            binary_accuracy(preds, device_targets),
+            binary_precision(preds, device_targets),
+            binary_recall(preds, device_targets),
+            binary_f1_score(preds, device_targets),
+            binary_average_precision(probs[:, 1], device_targets),
+        ]).tolist()
+        # bulk device -> host transfers, once per split
+        predictions = preds.tolist()
+        expectations = targets.tolist()
+        all_ids = torch.cat(ids_list).tolist()
+        all_probs = probs[:, 1].cpu().numpy()
         # print('pred', sum(predictions), sum(expectations))
-        pr_auc = average_precision_score(expectations, all_probs)
-
 
-
-        return acc(expectations, predictions), \
-               pr(expectations, predictions), \
-               rc(expectations, predictions), \
-               f1(expectations, predictions), \
-               pr_auc , expectations, all_probs , all_ids , predictions
+        return accuracy, precision, recall, f1_score, pr_auc , expectations, all_probs , all_ids , predictions
 
 
 def evaluate_patch(model, iterator_function, _batch_count, cuda_device, output_buffer=sys.stderr):
     # if output_buffer is not None:
     #     print(_batch_count, file=output_buffer)
     model.eval()
-    with torch.no_grad():
-        predictions = []
-        expectations = []
-        all_ids = []
-        batch_generator = range(_batch_count)
+    compiled = compile_model(model, cuda_device)
+    copy_stream = create_copy_stream(cuda_device)
+    with torch.inference_mode():
+        probs_list = []
+        tgt_list = []
+        ids_list = []
+        batch_generator = prefetch_batches(iterator_function, _batch_count)
         if output_buffer is not None:
-            batch_generator = tqdm(batch_generator)
-        for _ in batch_generator:
-            features, targets, ids = iterator_function()
-            if cuda_device != -1:
-                features = features.cuda(device=cuda_device)
-            probs, _, _ = model(example_batch=features)
-            batch_pred = np.argmax(probs.detach().cpu().numpy(), axis=-1).tolist()
-            batch_tgt = targets.detach().cpu().numpy().tolist()
-            batch_ids = ids.detach().cpu().numpy().tolist()
-            predictions.extend(batch_pred)
-            expectations.extend(batch_tgt)
-            all_ids.extend(batch_ids)
+            batch_generator = tqdm(batch_generator, total=_batch_count)
+        for features, targets, ids in batch_generator:
+            features, = to_device((features,), cuda_device, copy_stream)
+            with autocast(cuda_device):
+                probs, _, _ = compiled(example_batch=features)
+            probs_list.append(probs.clone())
+            tgt_list.append(targets)
+            ids_list.append(ids)
         model.train()
+        # one argmax over the whole split on the device; only the predicted labels cross to the host
+        # and are converted once up front so sklearn does not re-materialize Python lists per metric call
+        pred = torch.cat(probs_list).argmax(-1).cpu().numpy().astype(np.int8)
+        exp = torch.cat(tgt_list).numpy().astype(np.int8)
+        predictions = pred.tolist()
+        expectations = exp.tolist()
+        all_ids = torch.cat(ids_list).tolist()
         # print('pred', sum(predictions), sum(expectations))
 
-        return acc(expectations, predictions), \
-               pr(expectations, predictions), \
-               rc(expectations, predictions), \
-               f1(expectations, predictions), predictions, expectations, all_ids
+        return acc(exp, pred), \
+               pr(exp, pred), \
+               rc(exp, pred), \
+               f1(exp, pred), predictions, expectations, all_ids
 
 
 
 def tSNE_embedding(model, iterator_function, _batch_count, cuda_device , dataset_name, output_buffer=sys.stderr):
     model.eval()
+    compiled = compile_model(model, cuda_device)
+    copy_stream = create_copy_stream(cuda_device)
     print('***** Running tSNE embeddings *****')
-    all_tSNE_embedding = []
-    with torch.no_grad():
-        batch_generator = range(_batch_count)
+    with torch.inference_mode():
+        repr_list = []
+        label_list = []
+        batch_generator = prefetch_batches(iterator_function, _batch_count)
         if output_buffer is not None:
-            batch_generator = tqdm(batch_generator)
-        for _ in batch_generator:
-            iterator_values = iterator_function()
+            batch_generator = tqdm(batch_generator, total=_batch_count)
+        for iterator_values in batch_generator:
             features, labels = iterator_values[0], iterator_values[1]
-            if cuda_device != -1:
-                features = features.cuda(device=cuda_device)
-            _, repr, _ = model(example_batch=features)
-            repr = repr.detach().cpu().numpy()
-            print(repr.shape)
-            all_tSNE_embedding.extend(
-                [(embedding, label) for embedding, label in zip(repr.tolist(), labels.tolist())])
+            features, = to_device((features,), cuda_device, copy_stream)
+            with autocast(cuda_device):
+                _, repr, _ = compiled(example_batch=features)
+            repr_list.append(repr.to(torch.float32, copy=True))
+            label_list.append(labels)
+        repr = torch.cat(repr_list).cpu().numpy()
+        print(repr.shape)
+        all_tSNE_embedding = list(zip(repr.tolist(), torch.cat(label_list).tolist()))
 
 
     pickle.dump(all_tSNE_embedding,
@@ -256,23 +357,26 @@ def tSNE_embedding(model, iterator_function, _batch_count, cuda_device , dataset
 
 def show_representation(model, iterator_function, _batch_count, cuda_device, name, output_buffer=sys.stderr):
     model.eval()
-    with torch.no_grad():
-        representations = []
-        expected_targets = []
-        batch_generator = range(_batch_count)
+    compiled = compile_model(model, cuda_device)
+    copy_stream = create_copy_stream(cuda_device)
+    with torch.inference_mode():
+        repr_list = []
+        tgt_list = []
+        batch_generator = prefetch_batches(iterator_function, _batch_count)
         if output_buffer is not None:
-            batch_generator = tqdm(batch_generator)
-        for _ in batch_generator:
-            iterator_values = iterator_function()
+            batch_generator = tqdm(batch_generator, total=_batch_count)
+        for iterator_values in batch_generator:
             features, targets = iterator_values[0], iterator_values[1]
-            if cuda_device != -1:
-                features = features.cuda(device=cuda_device)
-            _, repr, _ = model(example_batch=features)
-            repr = repr.detach().cpu().numpy()
-            print(repr.shape)
-            representations.extend(repr.tolist())
-            expected_targets.extend(targets.numpy().tolist())
+            features, = to_device((features,), cuda_device, copy_stream)
+            with autocast(cuda_device):
+                _, repr, _ = compiled(example_batch=features)
+            repr_list.append(repr.to(torch.float32, copy=True))
+            tgt_list.append(targets)
         model.train()
+        repr = torch.cat(repr_list).cpu().numpy()
+        print(repr.shape)
+        representations = repr.tolist()
+        expected_targets = torch.cat(tgt_list).tolist()
         # print(np.array(representations).shape)
         # print(np.array(expected_targets).shape)
         plot_embedding(representations, expected_targets, title=name)
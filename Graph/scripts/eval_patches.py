@@ -27,6 +27,7 @@ import utils.word2vec as word2vec
 from utils.my_log import LogWriter
 import torch
 import torch.nn as nn
+from safetensors.torch import load_file
 import torch.nn.functional as F
 from dgl.dataloading import GraphDataLoader
 import argparse
@@ -518,7 +519,7 @@ def test(model, test_dl, test_ds, args, logger=None, vul=False, dev=None):
         if args.model == 'reveal':
             graph_embeddings = all_pred
             model = MetricLearningModel(input_dim=200, hidden_dim=256)
-            model.load_state_dict(torch.load(f'../models/reveal/{args.dataset}_best_f1.model'))
+            model.load_state_dict(load_file(f'../models/reveal/{args.dataset}_best_f1.safetensors'))
             model.to(dev)
             model.eval()
             debug('ggnn')
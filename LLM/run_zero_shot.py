@@ -1,27 +1,29 @@
-import json
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
+import orjson
+import torch.multiprocessing as mp
 from config import model_name
+from zero_shot import run
 
 all_gpus = [0,1,6,7]
 split_cnt = 2
 
 
+def load_split(path: Path):
+    return orjson.loads(path.read_bytes())
+
+
 if __name__ == '__main__':
     assert len(all_gpus) % split_cnt == 0 , print('split_cnt should be multiple of gpus')
     per_gpu_num = len(all_gpus) // split_cnt
 
-    all_p = []
     gpus_splits = [x.tolist() for x in np.array_split(all_gpus, split_cnt)]
 
-    for split_idx in range(split_cnt):
-        gpus = ','.join([str(gpu) for gpu in gpus_splits[split_idx]])
-        p = subprocess.Popen(f'python zero_shot.py --gpus="{gpus}" -split_idx={split_idx} -total_split_cnt={split_cnt}', shell=True,)
-        all_p.append(p)
-
-    [x.wait() for x in all_p ]
+    # one worker per gpu group; each sets CUDA_VISIBLE_DEVICES before touching CUDA and
+    # loads the model once for all prompts
+    mp.spawn(run, args=(gpus_splits, split_cnt), nprocs=split_cnt, join=True)
 
     # merge result
     print('begin merge result')
@@ -31,9 +33,22 @@ if __name__ == '__main__':
             break
 
         print(f'merge prompt{prompt_id}...')
-        merge_result = []
-        for split_idx in range(split_cnt):
-            split_result = json.load((save_dir / f'prompt_{prompt_id}_result_split_{split_idx}.json').open(mode='r'))
-            merge_result.extend(split_result)
-
-        json.dump(merge_result, (save_dir / f'prompt_{prompt_id}_result.json').open(mode='w'))
\ No newline at end of file
+        split_paths = [save_dir / f'prompt_{prompt_id}_result_split_{split_idx}.json' for split_idx in range(split_cnt)]
+        # stream the merged array out split by split; the next split is parsed while the current one
+        # is written, so at most two splits are resident instead of all of them plus the merged copy
+        with ThreadPoolExecutor(max_workers=1) as pool, \
+                (save_dir / f'prompt_{prompt_id}_result.json').open(mode='wb') as f:
+            next_split = pool.submit(load_split, split_paths[0])
+            f.write(b'[')
+            first = True
+            for split_idx in range(split_cnt):
+                split_result = next_split.result()
+                if split_idx + 1 < split_cnt:
+                    next_split = pool.submit(load_split, split_paths[split_idx + 1])
+                for item in split_result:
+                    if not first:
+                        f.write(b',')
+                    f.write(orjson.dumps(item))
+                    first = False
+                del split_result
+            f.write(b']')
\ No newline at end of file
@@ -131,5 +131,10 @@ def main(gpus: list, split_idx: int = 0, total_split_cnt: int = 1):
         json.dump(llm_result, open(save_dir / f'prompt_{prompt_id}_result_split_{split_idx}.json', mode='w'))
 
 
+def run(split_idx: int, gpus_splits: list, total_split_cnt: int):
+    # entry point for torch.multiprocessing.spawn, which passes the process rank as the first argument
+    main(gpus_splits[split_idx], split_idx, total_split_cnt)
+
+
 if __name__ == '__main__':
     fire.Fire(main)
@@ -1,9 +1,9 @@
-import torch
 from transformers import RobertaTokenizer
 from argparse import Namespace
 
 # def attention_interpretation(model,tokenizer:RobertaTokenizer,mini_batch , args:Namespace):
-def attention_interpretation(input_ids,attentions,tokenizer:RobertaTokenizer ):
+def attention_interpretation(input_ids,attention,tokenizer:RobertaTokenizer ):
+    # attention: per-token attention received, i.e. one layer's [heads, seq_len, seq_len] summed over heads and queries
     all_tokens = tokenizer.convert_ids_to_tokens(input_ids)
     raw_func = tokenizer.convert_tokens_to_string(all_tokens,)
     raw_func_loc = len(raw_func.split('\n'))
@@ -13,17 +13,10 @@ def attention_interpretation(input_ids,attentions,tokenizer:RobertaTokenizer ):
     # \n= Ċ
     # print(tokenizer.decode(input_ids))
     # print(all_tokens)
-    attention = None
-    for attention_layer in attentions:
-        sum_attention = torch.sum(attention_layer,0)
-        if attention is None:
-            attention = sum_attention
-        else:
-            attention += sum_attention
     attention = clean_special_token_values(input_ids , attention , tokenizer )
     # print(len(all_tokens))
     # print(all_tokens)
-    token_attn_score = [  (x[0],x[1].item()) for x in zip(all_tokens, attention) ]
+    token_attn_score = list(zip(all_tokens, attention.tolist()))
     # print(token_attn_score)
 
 
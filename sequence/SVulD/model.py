@@ -21,6 +21,8 @@ class Model(nn.Module):
         self.classifier = nn.Linear(config.hidden_size, 2)
 
     def get_xcode_vec(self, source_ids, need_attentions=False):
+        # the dataset ships int32 ids, the embedding lookup wants int64
+        source_ids = source_ids.long()
         mask = source_ids.ne(self.config.pad_token_id)
         out: BaseModelOutputWithPoolingAndCrossAttentions = self.encoder(source_ids, attention_mask=mask.unsqueeze(
             1) * mask.unsqueeze(2)
@@ -38,7 +40,21 @@ class Model(nn.Module):
 
     def forward(self, input_ids, contrast_ids=None, labels=None, need_attentions=False , output_tSNE_embedding = False):
 
-        vec, attentions = self.get_xcode_vec(input_ids, need_attentions=True)
+        # the extra dropout views (r_drop / simcse / simct) and the contrast view ride along in one encoder
+        # pass with input_ids; dropout masks are drawn per row, so the repeated rows still differ
+        batch_size = input_ids.shape[0]
+        labels = labels.long()
+        views = [input_ids]
+        if self.args.do_train:
+            views += [input_ids] * (self.args.r_drop + self.args.simcse + self.args.simct)
+            if self.args.simct:
+                views.append(contrast_ids)
+        vecs, attentions = self.get_xcode_vec(torch.cat(views, dim=0) if len(views) > 1 else input_ids,
+                                              need_attentions=True)
+        if len(views) > 1:
+            attentions = tuple(attention[:batch_size] for attention in attentions)
+        vecs = vecs.split(batch_size)
+        vec, extra_vecs = vecs[0], iter(vecs[1:])
         logits = self.classifier(vec)
         prob = nn.functional.softmax(logits, dim=-1)
 
@@ -47,7 +63,7 @@ class Model(nn.Module):
 
         if self.args.r_drop and self.args.do_train:
             # keep dropout twice
-            vec2 = self.get_xcode_vec(input_ids)
+            vec2 = next(extra_vecs)
             logits2 = self.classifier(vec2)
 
             # cross entropy loss for classifier
@@ -60,7 +76,7 @@ class Model(nn.Module):
 
         if self.args.simcse and self.args.do_train:
             # keep dropout twice
-            vec2 = self.get_xcode_vec(input_ids)
+            vec2 = next(extra_vecs)
             logits2 = self.classifier(vec2)
 
             simcse_loss = simcse_unsup_loss(torch.cat((vec, vec2), dim=0), device=self.args.device)
@@ -70,13 +86,13 @@ class Model(nn.Module):
 
         if self.args.simct and self.args.do_train:
             # keep dropout twice
-            vec2 = self.get_xcode_vec(input_ids)
+            vec2 = next(extra_vecs)
             logits2 = self.classifier(vec2)
 
             kl_loss = compute_kl_loss(logits, logits2)
 
             # dropout for contrast
-            vec3 = self.get_xcode_vec(contrast_ids)
+            vec3 = next(extra_vecs)
 
             simct_loss = simct_unsup_loss(vec, vec3, labels)
 
@@ -22,129 +22,235 @@ using a masked language modeling (MLM) loss.
 from __future__ import absolute_import, division, print_function
 
 import argparse
+import math
+import sys
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 import pickle
 from lib2to3.pgen2 import token
 import logging
 import os
 import random
+import re
 import json
+import orjson
 from pathlib import Path
 
 import torch
+import torch.distributed as dist
 import numpy as np
 import pandas as pd
 
-from torch.utils.data import DataLoader, Dataset, SequentialSampler, RandomSampler, TensorDataset
+from torch.utils.data import DataLoader, Dataset, Sampler, SequentialSampler, TensorDataset
 from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel as DDP
 from utils.early_stopping import EarlyStopping
 
 from model import Model
 from transformers import (WEIGHTS_NAME, get_linear_schedule_with_warmup,
-                          RobertaConfig, RobertaModel, RobertaTokenizer)
+                          RobertaConfig, RobertaModel, RobertaTokenizerFast)
 
 from torch.optim import AdamW
-from sklearn.metrics import accuracy_score, recall_score, precision_score, f1_score, roc_auc_score, auc, average_precision_score
+from sklearn.metrics import accuracy_score
+from torchmetrics.functional.classification import binary_accuracy, binary_recall, binary_precision, \
+    binary_f1_score, binary_average_precision, binary_auroc
 from tqdm import tqdm
 from interpret import attention_interpretation
 from my_utils import ModelParameterCounter,RunTimeCounter
 
 no_deprecation_warning=True
+# the fast tokenizer is already parallel in this process; this only lifts its fork-safety guard, which would
+# otherwise disable its thread pool in DataLoader workers forked after tokenizing. The workers never tokenize,
+# so the guard buys nothing here and setting it explicitly also silences the fork warning
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'true')
 logger = logging.getLogger(__name__)
 early_stopping = EarlyStopping()
 
-class InputFeatures(object):
-    """A single training/test features for a example."""
-    def __init__(self,
-                 input_tokens,
-                 input_ids,
-                 contrast_tokens,
-                 contrast_ids,
-                 label,
-                 index
-    ):
-        self.input_tokens = input_tokens
-        self.input_ids = input_ids
-        self.contrast_tokens = contrast_tokens
-        self.contrast_ids = contrast_ids
-        self.label = label
-        self.index = index
-
-
-def convert_examples_to_features(js,tokenizer,args):
-    """convert examples to token ids"""
-    # code = ' '.join(js['code'].split())
-    code = js['code']
-    code_tokens = tokenizer.tokenize(code)[:args.block_size-4]
-    source_tokens = [tokenizer.cls_token,"<encoder_only>",tokenizer.sep_token] + code_tokens + [tokenizer.sep_token]
-    source_ids = tokenizer.convert_tokens_to_ids(source_tokens)
-    padding_length = args.block_size - len(source_ids)
-    source_ids += [tokenizer.pad_token_id] * padding_length
-
-    # contrast = ' '.join(js['contrast'].split())
-    contrast = js['contrast']
-    contrast_tokens = tokenizer.tokenize(contrast)[:args.block_size-4]
-    contrast_tokens = [tokenizer.cls_token,"<encoder_only>",tokenizer.sep_token] + contrast_tokens + [tokenizer.sep_token]
-    contrast_ids = tokenizer.convert_tokens_to_ids(contrast_tokens)
-    padding_length = args.block_size - len(contrast_ids)
-    contrast_ids += [tokenizer.pad_token_id] * padding_length
-
-    return InputFeatures(source_tokens,source_ids,
-                         contrast_tokens,contrast_ids,
-                         js['label'],js['index'])
+def encode_to_block(texts, tokenizer, args):
+    """batch-encode texts with the fast tokenizer into `<s> <encoder_only> </s> code </s> <pad>...` rows"""
+    prefix_ids = tokenizer.convert_tokens_to_ids([tokenizer.cls_token,"<encoder_only>",tokenizer.sep_token])
+    # one batched call: the Rust backend encodes the whole list on its own thread pool
+    encoded = tokenizer(texts, add_special_tokens=False, truncation=True, max_length=args.block_size-4,
+                        padding='max_length', return_tensors='np')
+    code_lengths = encoded['attention_mask'].sum(-1)
+    block_ids = np.full((len(texts), args.block_size), tokenizer.pad_token_id, dtype=np.int32)
+    block_ids[:, :3] = prefix_ids
+    block_ids[:, 3:-1] = encoded['input_ids']
+    block_ids[np.arange(len(texts)), 3 + code_lengths] = tokenizer.sep_token_id
+    return block_ids
+
+
+def convert_examples_to_features(data,tokenizer,args):
+    """convert examples to (input_ids, contrast_ids, labels, indices) tensors, one row per example"""
+    source_ids = encode_to_block([js['code'] for js in data], tokenizer, args)
+    contrast_ids = encode_to_block([js['contrast'] for js in data], tokenizer, args)
+    return (torch.from_numpy(source_ids), torch.from_numpy(contrast_ids),
+            torch.tensor([js['label'] for js in data], dtype=torch.int32),
+            torch.tensor([js['index'] for js in data], dtype=torch.int32))
 
 
 class TextDataset(Dataset):
-    def __init__(self, tokenizer, args, file_path=None):
-        self.examples = []
-        data = json.load(open(file_path,mode='r'))
-        for js in tqdm(data):
-            self.examples.append(convert_examples_to_features(js,tokenizer,args))
+    def __init__(self, tokenizer, args, file_path=None, encode_contrast=None, all_ranks=False):
+        # tokenized features are cached next to the data file, keyed by block size, tokenizer and the data
+        # file's mtime/size, so regenerating the data file in place invalidates the cache.
+        # all_ranks: every DDP rank builds this dataset, so on a cold cache the first rank on each node
+        # tokenizes while the rest wait
+        stat = os.stat(file_path)
+        cache_base = f'{Path(file_path).name}.cache_{args.block_size}_{tokenizer.name_or_path.replace("/", "_")}'
+        cache_path = str(Path(file_path).parent / f'{cache_base}_{stat.st_mtime_ns}_{stat.st_size}.pt')
+        features = None
+        distributed = all_ranks and args.local_rank != -1
+        if not os.path.exists(cache_path) and (not distributed or args.local_rank == 0):
+            data = orjson.loads(Path(file_path).read_bytes())
+            features = convert_examples_to_features(data,tokenizer,args)
+            # write then rename, so other readers never see a partial cache
+            torch.save(features, f'{cache_path}.{os.getpid()}.tmp')
+            os.replace(f'{cache_path}.{os.getpid()}.tmp', cache_path)
+            # caches of earlier versions of this data file are never read again
+            stale_pattern = re.compile(re.escape(cache_base) + r'(_\d+_\d+)?\.pt')
+            for sibling in Path(file_path).parent.iterdir():
+                if stale_pattern.fullmatch(sibling.name) and sibling.name != Path(cache_path).name:
+                    sibling.unlink(missing_ok=True)
+        if distributed:
+            dist.barrier()
+        if features is None:
+            features = torch.load(cache_path)
+        # one contiguous int32 tensor per field; __getitem__ returns row views instead of building new tensors.
+        # int32 halves the host-to-device copy, Model casts back to int64 on device
+        self.input_ids, self.contrast_ids, self.labels, self.indices = (feature.int() for feature in features)
+        # rows are right-padded, so the non-pad count is the length. contrast_ids only reach the encoder
+        # under --simct training (or when the caller encodes them directly, as detect() does); otherwise
+        # their length is irrelevant and trimming them along with input_ids is harmless
+        self.pad_token_id = tokenizer.pad_token_id
+        self.encode_contrast = args.simct and args.do_train if encode_contrast is None else encode_contrast
+        self.lengths = self.encoded_lengths(self.input_ids, self.contrast_ids)
         if 'train' in file_path:
-            for idx, example in enumerate(self.examples[:3]):
+            for idx in range(min(3, len(self))):
                     logger.info("*** Example ***")
                     logger.info("idx: {}".format(idx))
-                    logger.info("label: {}".format(example.label))
-                    logger.info("input_tokens: {}".format([x.replace('\u0120','_') for x in example.input_tokens]))
-                    logger.info("input_ids: {}".format(' '.join(map(str, example.input_ids))))
+                    logger.info("label: {}".format(self.labels[idx].item()))
+                    input_tokens = tokenizer.convert_ids_to_tokens(self.input_ids[idx].tolist())
+                    logger.info("input_tokens: {}".format([x.replace('\u0120','_') for x in input_tokens]))
+                    logger.info("input_ids: {}".format(' '.join(map(str, self.input_ids[idx].tolist()))))
 
     def __len__(self):
-        return len(self.examples)
+        return len(self.labels)
 
     def __getitem__(self, i):
-        input_ids = self.examples[i].input_ids
-        contrast_ids = self.examples[i].contrast_ids
-        label = self.examples[i].label
-        index = self.examples[i].index
-        return (torch.tensor(input_ids),torch.tensor(contrast_ids),
-                torch.tensor(label),torch.tensor(index))
+        return self.input_ids[i], self.contrast_ids[i], self.labels[i], self.indices[i]
+
+    def encoded_lengths(self, input_ids, contrast_ids):
+        lengths = input_ids.ne(self.pad_token_id).sum(-1)
+        if self.encode_contrast:
+            lengths = torch.maximum(lengths, contrast_ids.ne(self.pad_token_id).sum(-1))
+        return lengths
+
+    def collate_fn(self, batch):
+        """stack a batch and cut the padding down to its longest encoded row, rounded up to a multiple of 64
+        so compiled graphs and cudnn autotuning only ever see ceil(block_size / 64) sequence lengths"""
+        input_ids, contrast_ids, labels, indices = (torch.stack(field) for field in zip(*batch))
+        length = int(self.encoded_lengths(input_ids, contrast_ids).max())
+        length = min(math.ceil(length / 64) * 64, input_ids.size(1))
+        return input_ids[:, :length].contiguous(), contrast_ids[:, :length].contiguous(), labels, indices
+
+
+class LengthBucketSampler(Sampler):
+    """Batch sampler that groups rows of similar length. Rows are shuffled, cut into buckets of
+    `batch_size * bucket_size_multiplier`, sorted by length inside each bucket and batched; the batch
+    order is then shuffled and sharded across ranks. Call set_epoch() to reshuffle."""
+    def __init__(self, lengths, batch_size, num_replicas=1, rank=0, seed=0, bucket_size_multiplier=50):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        # same seed on every rank, so all ranks agree on the batches before sharding
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        batches = []
+        for bucket in torch.randperm(len(self.lengths), generator=generator).split(self.bucket_size):
+            bucket = bucket[self.lengths[bucket].argsort(descending=True)]
+            batches.extend(bucket.split(self.batch_size))
+        order = torch.randperm(len(batches), generator=generator).tolist()
+        # every rank must run the same number of steps, wrap around like DistributedSampler does
+        total = len(self) * self.num_replicas
+        order = (order * math.ceil(total / len(order)))[:total]
+        for i in order[self.rank::self.num_replicas]:
+            yield batches[i].tolist()
+
+    def __len__(self):
+        return math.ceil(math.ceil(len(self.lengths) / self.batch_size) / self.num_replicas)
 
 
-def set_seed(seed=42):
+def set_seed(seed=42, deterministic=False):
     random.seed(seed)
-    os.environ['PYHTONHASHSEED'] = str(seed)
+    os.environ['PYTHONHASHSEED'] = str(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
-    torch.backends.cudnn.deterministic = True
+    if deterministic:
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
+    else:
+        torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision('high')
+
+
+def is_main_process(args):
+    return args.local_rank == -1 or dist.get_rank() == 0
+
+
+def unwrap_model(model):
+    # strip the torch.compile and DDP wrappers so state_dict keys match the plain Model
+    model = getattr(model, '_orig_mod', model)
+    return model.module if isinstance(model, DDP) else model
+
+
+def autocast(args):
+    return torch.autocast(device_type=args.device.type, dtype=torch.bfloat16 if args.bf16 else torch.float16,
+                          enabled=args.fp16 or args.bf16)
 
 
 def train(args, train_dataset, model, tokenizer):
     """ Train the model """
-    train_sampler = SequentialSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler,
-                                  batch_size=args.train_batch_size,
-                                  num_workers=16, pin_memory=True)
+    # similar-length rows are batched together and padded only to the batch's longest row;
+    # each rank sees a disjoint shard, set_epoch below reshuffles the batches every epoch
+    train_sampler = LengthBucketSampler(train_dataset.lengths, args.train_batch_size, num_replicas=args.world_size,
+                                        rank=dist.get_rank() if args.local_rank != -1 else 0, seed=args.seed)
+    train_dataloader = DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=train_dataset.collate_fn,
+                                  num_workers=2, pin_memory=True)
+    # built once and reused by the evaluation at the end of every epoch; under DDP each rank evaluates
+    # an interleaved shard and evaluate() gathers the shards back
+    eval_dataset = TextDataset(tokenizer, args, args.eval_data_file, all_ranks=True)
+    eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 \
+        else DistributedSampler(eval_dataset, shuffle=False)
+    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler,
+                                 batch_size=args.eval_batch_size, collate_fn=eval_dataset.collate_fn,
+                                 num_workers=4, pin_memory=True)
 
-    args.max_steps = args.num_train_epochs * len(train_dataloader)
+    # the last, possibly partial, accumulation window of every epoch also steps the optimizer
+    args.max_steps = args.num_train_epochs * math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
 
     # Prepare optimizer and schedule (linear warmup and decay)
-    no_decay = ['bias', 'LayerNorm.weight']
+    decay_params, no_decay_params = [], []
+    for n, p in model.named_parameters():
+        (no_decay_params if 'bias' in n or 'LayerNorm.weight' in n else decay_params).append(p)
     optimizer_grouped_parameters = [
-        {'params': [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)],
-         'weight_decay': args.weight_decay},
-        {'params': [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
+        {'params': decay_params, 'weight_decay': args.weight_decay},
+        {'params': no_decay_params, 'weight_decay': 0.0}
     ]
-    optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
+    try:
+        # single multi-tensor kernel per step; needs CUDA params and torch >= 2.0
+        optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon, fused=True)
+    except (TypeError, RuntimeError):
+        optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon, foreach=True)
     scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=args.max_steps*0.1,
                                                 num_training_steps=args.max_steps)
 
@@ -152,44 +258,59 @@ def train(args, train_dataset, model, tokenizer):
     logger.info("***** Running training *****")
     logger.info("  Num examples = %d", len(train_dataset))
     logger.info("  Num Epochs = %d", args.num_train_epochs)
-    logger.info("  Instantaneous batch size per GPU = %d", args.train_batch_size // args.n_gpu )
-    logger.info("  Total train batch size = %d", args.train_batch_size)
+    logger.info("  Instantaneous batch size per GPU = %d", args.train_batch_size)
+    logger.info("  Total train batch size = %d",
+                args.train_batch_size * args.world_size * args.gradient_accumulation_steps)
+    logger.info("  Gradient Accumulation steps = %d", args.gradient_accumulation_steps)
     logger.info("  Total optimization steps = %d", args.max_steps)
 
     losses, best_f1 = [], 0
+    # checkpoints are written by a single background thread so training moves on while the disk catches up
+    checkpoint_pool, checkpoint_future = ThreadPoolExecutor(max_workers=1), None
+    # bf16 has the fp32 exponent range, so loss scaling is only needed for fp16
+    scaler = torch.cuda.amp.GradScaler(enabled=args.fp16)
 
-    model.zero_grad()
+    model.zero_grad(set_to_none=True)
     for idx in range(args.num_train_epochs):
+        train_sampler.set_epoch(idx)
         for step, batch in enumerate(train_dataloader):
-            inputs = batch[0].to(args.device)
-            contrasts = batch[1].to(args.device)
-            labels = batch[2].to(args.device)
+            inputs = batch[0].to(args.device, non_blocking=True)
+            contrasts = batch[1].to(args.device, non_blocking=True)
+            labels = batch[2].to(args.device, non_blocking=True)
 
             model.train()
-            loss, _, = model(inputs, contrasts, labels)
-
-            if args.n_gpu > 1:
-                loss = loss.mean()  # mean() to average on multi-gpu parallel training
-
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+            sync_step = (step + 1) % args.gradient_accumulation_steps == 0 or step + 1 == len(train_dataloader)
+            # skip the gradient all-reduce on accumulation micro-steps; the forward has to be inside
+            # no_sync() as well, otherwise DDP's prepare_for_backward still triggers the reduction
+            sync_context = model.no_sync() if args.local_rank != -1 and not sync_step else contextlib.nullcontext()
+            with sync_context:
+                with autocast(args):
+                    loss, _, = model(inputs, contrasts, labels)
+                if args.gradient_accumulation_steps > 1:
+                    loss = loss / args.gradient_accumulation_steps
+
+                scaler.scale(loss).backward()
 
             # print('loss: {:.2f}'.format(loss.item()), end='\r')
-            losses.append(loss.item())
+            losses.append(loss.item() * args.gradient_accumulation_steps)
 
             if (step+1)% 100==0:
                 logger.info("epoch {} step {} loss {}".format(idx,step+1,round(np.mean(losses[-100:]),4)))
 
-            optimizer.step()
-            optimizer.zero_grad()
-            scheduler.step()
+            if sync_step:
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+                scheduler.step()
 
-        results, eval_loss ,_ , _ = evaluate(args, model, tokenizer, args.eval_data_file)
+        results, eval_loss ,_ , _ = evaluate(args, model, eval_dataloader)
 
         # for key, value in results.items():
         #     logger.info("  %s = %s", key, round(value,4))
 
-        if results['f1'] > best_f1:
+        if results['f1'] > best_f1 and is_main_process(args):
             best_f1 = results['f1']
             logger.info("  "+"*"*20)
             logger.info("  Best f1:%s",round(best_f1,4))
@@ -200,8 +321,9 @@ def train(args, train_dataset, model, tokenizer):
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
             output_dir = os.path.join(output_dir, 'model.bin')
-            model_to_save = model.model if hasattr(model, 'module') else model
-            torch.save(model_to_save.state_dict(), output_dir)
+            # snapshot to host now, the live weights keep changing while the save runs
+            state_dict = {k: v.detach().to('cpu', copy=True) for k, v in unwrap_model(model).state_dict().items()}
+            checkpoint_future = checkpoint_pool.submit(torch.save, state_dict, output_dir)
             logger.info("Saving model checkpoint to %s", output_dir)
 
         early_stopping(eval_loss)
@@ -209,57 +331,92 @@ def train(args, train_dataset, model, tokenizer):
             print("Early stopping")
             break
 
+    # the test phase reloads the checkpoint, so the last save has to be on disk before returning
+    checkpoint_pool.shutdown(wait=True)
+    if checkpoint_future is not None:
+        checkpoint_future.result()
 
-def evaluate(args, model, tokenizer, data_file):
-    """ Evaluate the model """
+
+def evaluate_from_file(args, model, tokenizer, data_file):
     eval_dataset = TextDataset(tokenizer, args, data_file)
     eval_sampler = SequentialSampler(eval_dataset)
     eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler,
-                                batch_size=args.eval_batch_size, num_workers=4)
+                                batch_size=args.eval_batch_size, collate_fn=eval_dataset.collate_fn,
+                                num_workers=4, pin_memory=True)
+    return evaluate(args, model, eval_dataloader)
+
+
+def gather_eval_shards(eval_loss, logits, labels, indices, num_examples):
+    """sum the per-rank losses and reassemble the DistributedSampler(shuffle=False) shards in dataset order"""
+    dist.all_reduce(eval_loss)
+    world_size = dist.get_world_size()
+    gathered = []
+    for shard in (logits, labels, indices):
+        full = shard.new_empty((world_size * shard.size(0),) + shard.shape[1:])
+        dist.all_gather_into_tensor(full, shard.contiguous())
+        # rank r holds rows r, r + world_size, ...; interleave them back and drop the sampler's wrap-around padding
+        gathered.append(full.view(world_size, shard.size(0), *shard.shape[1:]).transpose(0, 1)
+                        .reshape(-1, *shard.shape[1:])[:num_examples])
+    return (eval_loss, *gathered)
+
+
+def evaluate(args, model, eval_dataloader):
+    """ Evaluate the model """
+    eval_dataset = eval_dataloader.dataset
 
     # Eval!
     logger.info("***** Running evaluation *****")
     logger.info("  Num examples = %d", len(eval_dataset))
     logger.info("  Batch size = %d", args.eval_batch_size)
 
-    eval_loss = 0.0
+    # outputs are written into device buffers and copied back once, instead of syncing on every batch
+    eval_loss = torch.zeros((), device=args.device)
     nb_eval_steps = 0
     model.eval()
-    logits=[]
-    labels=[]
-    indices=[]
-    for batch in eval_dataloader:
-        input = batch[0].to(args.device)
-        contrast = batch[1].to(args.device)
-        label = batch[2].to(args.device)
-        index = batch[3].to(args.device)
-        with torch.no_grad():
-            lm_loss, logit = model(input, contrast, label)
-            eval_loss += lm_loss.mean().item()
-            logits.append(logit.cpu().numpy())
-            labels.append(label.cpu().numpy())
-            indices.append(index.cpu().numpy())
-        nb_eval_steps += 1
-    logits = np.concatenate(logits,0)
-    labels = np.concatenate(labels,0)
-    indices = np.concatenate(indices,0)
+    num_samples = len(eval_dataloader.sampler)
+    logits = torch.empty((num_samples, 2), device=args.device)
+    labels = torch.empty(num_samples, dtype=eval_dataset.labels.dtype, device=args.device)
+    indices = torch.empty(num_samples, dtype=eval_dataset.indices.dtype, device=args.device)
+    ptr = 0
+    with torch.inference_mode():
+        for batch in eval_dataloader:
+            input = batch[0].to(args.device, non_blocking=True)
+            contrast = batch[1].to(args.device, non_blocking=True)
+            label = batch[2].to(args.device, non_blocking=True)
+            index = batch[3].to(args.device, non_blocking=True)
+            with autocast(args):
+                lm_loss, logit = model(input, contrast, label)
+                eval_loss += lm_loss.mean()
+                batch_size = input.size(0)
+                logits[ptr:ptr + batch_size] = logit
+                labels[ptr:ptr + batch_size] = label
+                indices[ptr:ptr + batch_size] = index
+                ptr += batch_size
+            nb_eval_steps += 1
+    if isinstance(eval_dataloader.sampler, DistributedSampler):
+        # every rank ends up with the same full outputs and loss, so metrics and early stopping agree
+        eval_loss, logits, labels, indices = gather_eval_shards(eval_loss, logits, labels, indices, len(eval_dataset))
     preds = logits[:, 1] > 0.5
-
-    acc = accuracy_score(labels, preds)
-    recall = recall_score(labels, preds)
-    precision = precision_score(labels, preds)
-    f1 = f1_score(labels, preds)
-    pr_auc = average_precision_score(labels, logits[:, 1])
-    roc_auc = roc_auc_score(labels, logits[:, 1])
+    # metrics are computed on device; only the scalars cross back to the host
+    labels = labels.long()
+    acc, recall, precision, f1, pr_auc, roc_auc = torch.stack([
+        binary_accuracy(preds, labels),
+        binary_recall(preds, labels),
+        binary_precision(preds, labels),
+        binary_f1_score(preds, labels),
+        binary_average_precision(logits[:, 1], labels),
+        binary_auroc(logits[:, 1], labels),
+    ]).tolist()
+    eval_loss = eval_loss.item()
     results = {
-        "acc": float(acc),
-        "recall": float(recall),
-        "precision": float(precision),
-        "f1": float(f1),
-        "pr_auc": float(pr_auc),
-        "roc_auc": float(roc_auc)
+        "acc": acc,
+        "recall": recall,
+        "precision": precision,
+        "f1": f1,
+        "pr_auc": pr_auc,
+        "roc_auc": roc_auc
     }
-    return results, eval_loss , indices , preds
+    return results, eval_loss , indices.cpu().numpy() , preds.cpu().numpy()
 
 
 def interpret(args, model, tokenizer, data_file):
@@ -267,28 +424,33 @@ def interpret(args, model, tokenizer, data_file):
     eval_dataset = TextDataset(tokenizer, args, data_file)
     eval_sampler = SequentialSampler(eval_dataset)
     eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler,
-                                batch_size=args.eval_batch_size, num_workers=4)
+                                batch_size=args.eval_batch_size, num_workers=4, pin_memory=True)
 
     # Eval!
     logger.info("***** Running evaluation *****")
     interpret_results = []
-    for batch in tqdm(eval_dataloader):
-        input = batch[0].to(args.device)
-        contrast = batch[1].to(args.device)
-        label = batch[2].to(args.device)
-        dataset_id = batch[3].to(args.device)
-        with torch.no_grad():
+    model.eval()
+    with torch.inference_mode():
+        for batch in tqdm(eval_dataloader, mininterval=1.0, miniters=max(1, len(eval_dataloader) // 100),
+                          disable=not sys.stderr.isatty()):
+            input = batch[0].to(args.device, non_blocking=True)
+            contrast = batch[1].to(args.device, non_blocking=True)
+            label = batch[2].to(args.device, non_blocking=True)
+            dataset_id = batch[3].to(args.device, non_blocking=True)
             bs_size = input.shape[0]
             lm_loss, logit , attentions = model(input, contrast, label,need_attentions=True)
-            attentions = attentions[0]  # get first layer
-            preds = logit.cpu().numpy()[:, 1] > 0.5
-
+            # first layer, reduced over heads and queries on device: [bs_size, seq_len] attention received per token
+            token_attentions = attentions[0].float().sum(dim=(1, 2)).cpu()
+            preds = (logit[:, 1] > 0.5).tolist()
+            # one bulk device -> host transfer per batch instead of one per example
+            input_ids = input.tolist()
+            dataset_ids = dataset_id.tolist()
 
             for idx in range(bs_size):
-                line_scores , line_token_level_scores = attention_interpretation(input[idx].cpu().tolist(),attentions[idx],tokenizer)
+                line_scores , line_token_level_scores = attention_interpretation(input_ids[idx],token_attentions[idx],tokenizer)
                 interpret_results.append({
-                    "id" : dataset_id[idx].item(),
-                    "pred": preds[idx].item(),
+                    "id" : dataset_ids[idx],
+                    "pred": preds[idx],
                     "line_scores" : line_scores,
                     "line_token_level_scores" : line_token_level_scores
                 })
@@ -302,17 +464,19 @@ def tSNE_embedding(args, model, tokenizer, data_file):
     eval_dataset = TextDataset(tokenizer, args, data_file)
     eval_sampler = SequentialSampler(eval_dataset)
     eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler,
-                                batch_size=args.eval_batch_size, num_workers=4)
+                                batch_size=args.eval_batch_size, num_workers=4, pin_memory=True)
 
     # Eval!
     logger.info("***** Running tSNE embeddings *****")
     all_tSNE_embedding = []
-    for batch in tqdm(eval_dataloader):
-        input = batch[0].to(args.device)
-        contrast = batch[1].to(args.device)
-        labels = batch[2].to(args.device)
-        dataset_id = batch[3].to(args.device)
-        with torch.no_grad():
+    model.eval()
+    with torch.inference_mode():
+        for batch in tqdm(eval_dataloader, mininterval=1.0, miniters=max(1, len(eval_dataloader) // 100),
+                          disable=not sys.stderr.isatty()):
+            input = batch[0].to(args.device, non_blocking=True)
+            contrast = batch[1].to(args.device, non_blocking=True)
+            labels = batch[2].to(args.device, non_blocking=True)
+            dataset_id = batch[3].to(args.device, non_blocking=True)
             bs_size = input.shape[0]
             _, _ , tSNE_embedding = model(input, contrast, labels,output_tSNE_embedding=True)
             all_tSNE_embedding.extend(
@@ -324,10 +488,11 @@ def tSNE_embedding(args, model, tokenizer, data_file):
 
 
 def detect(args, model, tokenizer, data_file):
-    detect_dataset = TextDataset(tokenizer, args, data_file)
+    detect_dataset = TextDataset(tokenizer, args, data_file, encode_contrast=True)
     detect_sampler = SequentialSampler(detect_dataset)
     detect_dataloader = DataLoader(detect_dataset, sampler=detect_sampler,
-                                batch_size=args.eval_batch_size, num_workers=4)
+                                batch_size=args.eval_batch_size, collate_fn=detect_dataset.collate_fn,
+                                num_workers=4, pin_memory=True)
 
     eval_output_dir = args.output_dir
     if not os.path.exists(eval_output_dir):
@@ -340,21 +505,25 @@ def detect(args, model, tokenizer, data_file):
 
     nb_eval_steps = 0
     model.eval()
-    logits=[]
-    labels=[]
-    indices=[]
-    for batch in detect_dataloader:
-        contrast = batch[1].to(args.device)
-        label = batch[2].to(args.device)
-        index = batch[3].to(args.device)
-        with torch.no_grad():
+    logits = torch.empty((len(detect_dataset), 2), device=args.device)
+    labels = torch.empty(len(detect_dataset), dtype=detect_dataset.labels.dtype, device=args.device)
+    indices = torch.empty(len(detect_dataset), dtype=detect_dataset.indices.dtype, device=args.device)
+    ptr = 0
+    with torch.inference_mode():
+        for batch in detect_dataloader:
+            contrast = batch[1].to(args.device, non_blocking=True)
+            label = batch[2].to(args.device, non_blocking=True)
+            index = batch[3].to(args.device, non_blocking=True)
             _, logit = model(contrast, None, label)
-            logits.append(logit.cpu().numpy())
-            labels.append(label.cpu().numpy())
-            indices.append(index.cpu().numpy())
-        nb_eval_steps += 1
-    logits = np.concatenate(logits,0)
-    labels = np.concatenate(labels,0)
+            batch_size = contrast.size(0)
+            logits[ptr:ptr + batch_size] = logit
+            labels[ptr:ptr + batch_size] = label
+            indices[ptr:ptr + batch_size] = index
+            ptr += batch_size
+            nb_eval_steps += 1
+    logits = logits.cpu().numpy()
+    labels = labels.cpu().numpy()
+    indices = indices.cpu().numpy()
     preds = logits[:, 1] > 0.5
 
     acc = accuracy_score(labels, preds)
@@ -392,6 +561,8 @@ def main():
                         help="Batch size per GPU/CPU for training.")
     parser.add_argument("--eval_batch_size", default=4, type=int,
                         help="Batch size per GPU/CPU for evaluation.")
+    parser.add_argument('--gradient_accumulation_steps', type=int, default=1,
+                        help="Number of updates steps to accumulate before performing a backward/update pass.")
     parser.add_argument("--learning_rate", default=5e-5, type=float,
                         help="The initial learning rate for Adam.")
     parser.add_argument("--weight_decay", default=0.0, type=float,
@@ -402,8 +573,19 @@ def main():
                         help="Max gradient norm.")
     parser.add_argument("--num_train_epochs", default=1, type=int,
                         help="Total number of training epochs to perform.")
+    precision = parser.add_mutually_exclusive_group()
+    precision.add_argument('--fp16', action='store_true',
+                        help="Whether to use fp16 mixed precision with loss scaling.")
+    precision.add_argument('--bf16', action='store_true',
+                        help="Whether to use bf16 mixed precision (Ampere+), no loss scaling needed.")
+    parser.add_argument('--compile', action='store_true',
+                        help="Whether to torch.compile the model. One static graph (and CUDA graph) is compiled per "
+                             "padded sequence length, train/eval mode and tail batch size; the dynamo cache limit is "
+                             "raised to fit them.")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
+    parser.add_argument('--deterministic', action='store_true',
+                        help="Whether to force deterministic cuDNN kernels (slower).")
     parser.add_argument('--simcse', action='store_true',
                         help="")
     parser.add_argument('--simct', action='store_true',
@@ -415,49 +597,80 @@ def main():
     # Print arguments
     args = parser.parse_args()
 
+    # Set device, one process per GPU when launched with `torchrun --nproc_per_node=N`
+    args.local_rank = int(os.environ.get('LOCAL_RANK', -1))
+    if args.local_rank == -1:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        args.n_gpu = min(torch.cuda.device_count(), 1)
+        args.world_size = 1
+    else:
+        torch.cuda.set_device(args.local_rank)
+        device = torch.device("cuda", args.local_rank)
+        dist.init_process_group(backend='nccl')
+        args.n_gpu = 1
+        args.world_size = dist.get_world_size()
+    args.device = device
+
     # Set log
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
-                    datefmt='%m/%d/%Y %H:%M:%S',level=logging.INFO )
-
-    # Set device
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    args.n_gpu = torch.cuda.device_count()
-    args.device = device
-    logger.info("device: %s, n_gpu: %s", device, args.n_gpu)
+                    datefmt='%m/%d/%Y %H:%M:%S',level=logging.INFO if is_main_process(args) else logging.WARN)
+    logger.info("device: %s, n_gpu: %s, world_size: %s", device, args.n_gpu, args.world_size)
+    if args.local_rank == -1 and torch.cuda.device_count() > 1:
+        logger.warning("%d GPUs are visible but only one is used; launch with "
+                       "`torchrun --nproc_per_node=%d run.py ...` to train on all of them",
+                       torch.cuda.device_count(), torch.cuda.device_count())
 
     # Set seed
-    set_seed(args.seed)
+    set_seed(args.seed, args.deterministic)
 
     # Build model
-    tokenizer = RobertaTokenizer.from_pretrained(args.model_name_or_path)
+    tokenizer = RobertaTokenizerFast.from_pretrained(args.model_name_or_path)
     config = RobertaConfig.from_pretrained(args.model_name_or_path)
     model = RobertaModel.from_pretrained(args.model_name_or_path)
 
+    # the pooler output is never used; freezing it keeps DDP from waiting on gradients that never arrive
+    if model.pooler is not None:
+        model.pooler.requires_grad_(False)
+
     model = Model(model, config, tokenizer, args)
-    ModelParameterCounter().summary(model,'SVulD')
+    if is_main_process(args):
+        ModelParameterCounter().summary(model,'SVulD')
     logger.info("Training/evaluation parameters %s", args)
 
     model.to(args.device)
-    if args.n_gpu > 1:
-        model = torch.nn.DataParallel(model)
+    if args.local_rank != -1:
+        model = DDP(model, device_ids=[args.local_rank], output_device=args.local_rank)
+    if args.compile:
+        # compiled after DDP so dynamo can split graphs at bucket boundaries. Batches are trimmed to a multiple
+        # of 64 (see TextDataset.collate_fn), so shapes are not static: each sequence length x train/eval mode x
+        # full/tail batch is its own graph. Past the cache limit dynamo silently falls back to eager, so make
+        # room for all of them
+        max_graphs = math.ceil(args.block_size / 64) * 2 * 2
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, max_graphs)
+        if hasattr(torch._dynamo.config, 'accumulated_cache_size_limit'):
+            torch._dynamo.config.accumulated_cache_size_limit = max(
+                torch._dynamo.config.accumulated_cache_size_limit, max_graphs)
+        model = torch.compile(model, mode='reduce-overhead', fullgraph=False, dynamic=False)
 
     time_counter = RunTimeCounter()
     # Training
     if args.do_train:
-        train_dataset = TextDataset(tokenizer, args, args.train_data_file)
+        train_dataset = TextDataset(tokenizer, args, args.train_data_file, all_ranks=True)
         train(args, train_dataset, model, tokenizer)
-        time_counter.stop('SVulD train done!')
+        if is_main_process(args):
+            time_counter.stop('SVulD train done!')
 
 
     # Testing
-    if args.do_test:
+    if args.do_test and is_main_process(args):
         checkpoint_prefix = 'checkpoint-best-f1/model.bin'
         output_dir = os.path.join(args.output_dir, '{}'.format(checkpoint_prefix))
-        model_to_load = model.module if hasattr(model, 'module') else model
-        model_to_load.load_state_dict(torch.load(output_dir))
-        # tSNE_embedding(args, model, tokenizer, args.test_data_file)
-        # interpret(args, model, tokenizer, args.test_data_file)
-        result, _ , indices, preds  = evaluate(args, model, tokenizer, args.test_data_file)
+        # only rank 0 runs this, so bypass DDP: its forward broadcasts buffers the other ranks would never join
+        model_to_eval = unwrap_model(model)
+        model_to_eval.load_state_dict(torch.load(output_dir))
+        # tSNE_embedding(args, model_to_eval, tokenizer, args.test_data_file)
+        # interpret(args, model_to_eval, tokenizer, args.test_data_file)
+        result, _ , indices, preds  = evaluate_from_file(args, model_to_eval, tokenizer, args.test_data_file)
         logger.info("***** Test results *****")
         for key in sorted(result.keys()):
             logger.info("  %s = %s", key, str(round(result[key]*100 if "map" in key else result[key],4)))
@@ -469,18 +682,21 @@ def main():
         time_counter.stop('SVulD test done!')
 
     # Detect
-    if args.do_detect:
+    if args.do_detect and is_main_process(args):
         checkpoint_prefix = 'checkpoint-best-f1/model.bin'
         output_dir = os.path.join(args.output_dir, '{}'.format(checkpoint_prefix))
-        model_to_load = model.module if hasattr(model, 'module') else model
-        model_to_load.load_state_dict(torch.load(output_dir))
-        result, indices, preds = detect(args, model, tokenizer, args.test_data_file)
+        model_to_eval = unwrap_model(model)
+        model_to_eval.load_state_dict(torch.load(output_dir))
+        result, indices, preds = detect(args, model_to_eval, tokenizer, args.test_data_file)
         logger.info("***** Detect results *****")
         for key in sorted(result.keys()):
             logger.info("  %s = %s", key, str(round(result[key]*100 if "map" in key else result[key],4)))
         dataframe = pd.DataFrame({"index": indices, "pred": preds})
         dataframe.to_csv(f'{args.output_dir.replace("saved_models", "detect")}.csv', sep=',', index=False)
 
+    if args.local_rank != -1:
+        dist.destroy_process_group()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file